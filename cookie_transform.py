@@ -5,25 +5,24 @@
 
 import pickle
 
-COOKIE_KEYS = ["domain", "httpOnly", "path", "secure", "expiry", "name", "value"]
-cookies = []
-
 with open("cookies.txt", "r") as infile:
-    for line in infile.read().split("\n"):
-
+    cookies = [
+        {
+            "domain": fields[0],
+            # convert some values to booleans and integers
+            "httpOnly": fields[1] == "TRUE",
+            "path": fields[2],
+            "secure": fields[3] == "TRUE",
+            "expiry": int(fields[4]),
+            "name": fields[5],
+            "value": fields[6],
+        }
+        for line in infile
         # skip empty lines and comments
-        if not line or line.startswith("#"):
-            continue
-
-        # create dict from values
-        cookie = dict(zip(COOKIE_KEYS, line.split("\t")))
-
-        # convert some values to booleans and integers
-        cookie['httpOnly'] = cookie['httpOnly'] == "TRUE"
-        cookie['secure'] = cookie['secure'] == "TRUE"
-        cookie['expiry'] = int(cookie['expiry'])
-
-        cookies.append(cookie)
+        if line.strip() and not line.startswith("#")
+        for fields in (line.rstrip("\n").split("\t"),)
+        if len(fields) == 7
+    ]
 
 with open("cookies.pkl", "wb") as ofile:
-    pickle.dump(cookies, ofile)
+    pickle.dump(cookies, ofile, protocol=pickle.HIGHEST_PROTOCOL)
@@ -4,9 +4,13 @@ import argparse
 import os
 import sys
 import pickle
+import threading
 import time
 import json
 
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
 try:
     from selenium import webdriver
 except ImportError:
@@ -18,6 +22,14 @@ except ImportError:
 from selenium.common.exceptions import UnableToSetCookieException
 from selenium.common.exceptions import WebDriverException
 from selenium.common.exceptions import InvalidCookieDomainException
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
+
+# Use faster json parser for (possibly long) url lists if available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 
 # Delete button title html attribute
@@ -25,9 +37,19 @@ DELETE_BUTTON_TITLE = "Delete"  # "Smazat"
 # Text inside the confirmation button
 CONFIRMATION_TEXT = "Move to bin"  # "Přesunout do koše"
 
+# Geckodriver placed in the same folder as this script
+LOCAL_DRIVER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'geckodriver')
+
 # Google photos server address
 SERVER_ADDRESS = 'https://photos.google.com/'
 
+# How long to wait for the delete button and confirmation box (in seconds)
+BUTTON_TIMEOUT = 5
+CONFIRM_TIMEOUT = 3
+
+# Maximum number of concurrent background requests when checking photos
+BULK_CONCURRENCY = 16
+
 JS_CLICK_DELETE = f"""
 node = document.querySelector('[aria-label="{DELETE_BUTTON_TITLE}"]');
 if (node == null)
@@ -47,29 +69,88 @@ for (const span of document.querySelectorAll("span")) {{
 return found;
 """
 
+# Redirects are not followed (their status is reported as 302), as whether
+# the productUrl address is redirected tells if the photo still exists.
+JS_BULK_STATUS = """
+const urls = arguments[0];
+const limit = arguments[1];
+const done = arguments[arguments.length - 1];
+const statuses = new Array(urls.length);
+let next = 0;
+async function worker() {
+  while (next < urls.length) {
+    const i = next++;
+    try {
+      const response = await fetch(urls[i],
+        {method: "HEAD", credentials: "include", redirect: "manual"});
+      statuses[i] = response.type === "opaqueredirect" ? 302 : response.status;
+    } catch (err) {
+      statuses[i] = 0;
+    }
+  }
+}
+const workers = [];
+for (let i = 0; i < Math.min(limit, urls.length); i++)
+  workers.push(worker());
+Promise.all(workers).then(() => done(statuses));
+"""
 
-def init_driver(remember_user, driver_location=None):
-    """Return initialized and logged-in driver or None if error occurred."""
 
-    if driver_location is None:
+def start_driver(driver_location=None, headless=False):
+    """Return freshly started driver or None if error occurred."""
 
-        # get current location
-        current = os.path.dirname(os.path.realpath(__file__))
-        local_driver = os.path.join(current, 'geckodriver')
+    if driver_location is None:
 
         # check if current folder contains geckodriver
-        if os.path.exists(local_driver):
-            driver_location = local_driver
+        if os.path.exists(LOCAL_DRIVER):
+            driver_location = LOCAL_DRIVER
         else:
             # fallback to geckodriver in PATH
             driver_location = "geckodriver"
 
+    # Don't wait for all the images and other subresources of each photo page
+    # to load, delete button can be clicked as soon as the DOM is ready.
+    options = webdriver.FirefoxOptions()
+    options.page_load_strategy = "eager"
+
+    if headless:
+        # Nothing is painted without a window and we don't need image pixels
+        # to press the delete button either.
+        options.add_argument("-headless")
+        options.add_argument("--width=1280")
+        options.add_argument("--height=900")
+        options.set_preference("permissions.default.image", 2)
+
     try:
-        driver = webdriver.Firefox(executable_path=driver_location)
+        return webdriver.Firefox(executable_path=driver_location, options=options)
     except WebDriverException as err:
         print(f"Cannot start the gecko web driver.\n{err}", end="")
         return None
 
+
+def add_cookies(driver, cookies):
+    """Add all given cookies into the driver, skipping unsuitable ones."""
+
+    # Each add_cookie call is a separate round trip to the driver, so don't
+    # even try those which cannot be set for the Google Photos domain.
+    host = urlparse(SERVER_ADDRESS).hostname
+    for cookie in cookies:
+        domain = cookie.get('domain', host).lstrip('.')
+        if host != domain and not host.endswith(f".{domain}"):
+            continue
+        try:
+            driver.add_cookie(cookie)
+        except (UnableToSetCookieException, InvalidCookieDomainException):
+            continue
+
+
+def init_driver(remember_user, driver_location=None, headless=False):
+    """Return initialized and logged-in driver or None if error occurred."""
+
+    driver = start_driver(driver_location, headless)
+    if driver is None:
+        return None
+
     driver.get(SERVER_ADDRESS)
 
     # Load previously saved cookie file if it exists
@@ -77,12 +158,7 @@ def init_driver(remember_user, driver_location=None):
     try:
         print("Loading cookies ...", end="")
         with open("cookies.pkl", "rb") as infile:
-            cookies = pickle.load(infile)
-            for cookie in cookies:
-                try:
-                    driver.add_cookie(cookie)
-                except (UnableToSetCookieException, InvalidCookieDomainException):
-                    continue
+            add_cookies(driver, pickle.load(infile))
         cookies_success = True
         print(" ok")
     except FileNotFoundError as err:
@@ -100,6 +176,11 @@ def init_driver(remember_user, driver_location=None):
             print("Loaded cookies are not enough to log into Google Photos")
             cookies_success = False
 
+    if not cookies_success and headless:
+        print("Cannot login without a browser window, run without --headless first")
+        driver.quit()
+        return None
+
     if not cookies_success:
         input("Please, login into your google photos and press any key.")
         driver.get(SERVER_ADDRESS)
@@ -112,16 +193,76 @@ def init_driver(remember_user, driver_location=None):
     # Save cookies for a future use (must be logged in here)
     if remember_user:
         with open("cookies.pkl", "wb") as file:
-            pickle.dump(driver.get_cookies(), file)
+            pickle.dump(driver.get_cookies(), file, protocol=pickle.HIGHEST_PROTOCOL)
 
     return driver
 
 
-def delete_images(driver, url_list):
-    """Delete Google Photo images from given urls"""
+def clone_driver(driver, driver_location=None, headless=False):
+    """Return new driver logged-in with cookies of the given one or None."""
+
+    clone = start_driver(driver_location, headless)
+    if clone is None:
+        return None
+
+    clone.get(SERVER_ADDRESS)
+    add_cookies(clone, driver.get_cookies())
+
+    clone.get(SERVER_ADDRESS)
+    if clone.current_url != SERVER_ADDRESS:
+        print("Cannot log additional worker into the Google Photos")
+        clone.quit()
+        return None
+
+    return clone
+
+
+def process_parallel(drivers, url_list):
+    """Delete given images using all drivers and return those still not deleted."""
+
+    # Set on interrupt (or any other error) to stop all workers
+    stop = threading.Event()
+
+    def process(driver, chunk):
+        delete_images(driver, chunk, stop)
+        if stop.is_set():
+            return []
+        return test_deleted(driver, chunk)
+
+    # Distribute urls among drivers in a round robin fashion
+    chunks = [url_list[i::len(drivers)] for i in range(len(drivers))]
+
+    executor = ThreadPoolExecutor(max_workers=len(drivers))
+    futures = [executor.submit(process, driver, chunk) for driver, chunk in zip(drivers, chunks)]
+
+    problematic = []
+    try:
+        for future in futures:
+            problematic.extend(future.result())
+    except BaseException:
+        # Don't wait for workers to process their whole chunks, deleting
+        # must stop right away (drivers are closed by the caller).
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+
+    executor.shutdown()
+    return problematic
+
+
+def delete_images(driver, url_list, stop=None):
+    """Delete Google Photo images from given urls
+
+    Deleting ends early once the optional stop event is set.
+    """
 
     total = len(url_list)
     for i, url in enumerate(url_list, 1):
+        if stop is not None and stop.is_set():
+            print(f"[{i}/{total}] Stopped.")
+            return
 
         # Load page with current photograph
         try:
@@ -140,25 +281,26 @@ def delete_images(driver, url_list):
             continue
 
         # Click the delete button
-        # Webpage is fully loaded now and so this element should already exist
-        success = driver.execute_script(JS_CLICK_DELETE)
-        if not success:
-            # check if this photo was already deleted
-            if "Error 404" in driver.title:
-                print(f"[{i}/{total}] This photo was probably already deleted.")
-            else:
-                print(f"[{i}/{total}] Cannot locate delete button.")
+        # Only the DOM is loaded now (eager strategy) so wait for the button
+        # to appear unless this page is the one of already deleted photo.
+        try:
+            WebDriverWait(driver, BUTTON_TIMEOUT, poll_frequency=0.05).until(
+                lambda drv: drv.execute_script(JS_CLICK_DELETE) or "Error 404" in drv.title)
+        except TimeoutException:
+            print(f"[{i}/{total}] Cannot locate delete button.")
             continue
 
-        attempts = 12
-        # This can take a little while to load so try it multiple times
-        for _ in range(attempts):
-            success = driver.execute_script(JS_CONFIRM_DELETE)
-            if success:
-                break
-            time.sleep(0.25)
-        else:
-            print(f"[{i}/{total}] Could not locate confirm box after {attempts} attempts.")
+        # check if this photo was already deleted
+        if "Error 404" in driver.title:
+            print(f"[{i}/{total}] This photo was probably already deleted.")
+            continue
+
+        # This can take a little while to load so wait for it
+        try:
+            WebDriverWait(driver, CONFIRM_TIMEOUT, poll_frequency=0.05).until(
+                lambda drv: drv.execute_script(JS_CONFIRM_DELETE))
+        except TimeoutException:
+            print(f"[{i}/{total}] Could not locate confirm box after {CONFIRM_TIMEOUT} seconds.")
             continue
 
         print(f"[{i}/{total}] ok")
@@ -169,8 +311,34 @@ def delete_images(driver, url_list):
 def test_deleted(driver, url_list):
     """Return images that are still not deleted."""
 
+    # Check status codes of all pages at once with background requests from
+    # the Google Photos page itself (so that they are authenticated).
+    if not driver.current_url.startswith(SERVER_ADDRESS):
+        driver.get(SERVER_ADDRESS)
+
+    try:
+        driver.set_script_timeout(30 + len(url_list) // 10)
+        statuses = driver.execute_async_script(JS_BULK_STATUS, url_list, BULK_CONCURRENCY)
+    except WebDriverException as err:
+        print(f"Cannot check photos all at once, trying one by one.\n{err}")
+        return test_deleted_one_by_one(driver, url_list)
+
+    def is_deleted(url, status):
+        # Deleted photos are answered with 404 status code
+        if status == 404:
+            return True
+        # If given address is the productUrl from Google API, server will
+        # not redirect on image not found error.
+        return "photos.google.com/lr/photo/" in url and status not in (0, 302)
+
+    return [url for url, status in zip(url_list, statuses) if not is_deleted(url, status)]
+
+
+def test_deleted_one_by_one(driver, url_list):
+    """Return images that are still not deleted (by visiting all of them)."""
+
     # First load something that is definitely not current photo
-    driver.get(SERVER_ADDRESS)
+    driver.get("about:blank")
 
     problematic = []
     for url in url_list:
@@ -204,6 +372,10 @@ def main():
         help="Path to geckodriver executable (optional).")
     parser.add_argument("-r", "--remember-user", action='store_true',
         help="Remember login cookie (save it to current directory).")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+        help="Number of browser windows deleting in parallel (default 4).")
+    parser.add_argument("--headless", action='store_true',
+        help="Run browsers without windows (requires remembered login).")
     args = parser.parse_args()
 
     if args.file is None and not args.url:
@@ -212,9 +384,9 @@ def main():
     file_data = []
     if args.file:
         try:
-            with open(args.file, "r") as infile:
-                file_data = json.load(infile)
-        except (IOError, json.decoder.JSONDecodeError) as err:
+            with open(args.file, "rb") as infile:
+                file_data = json_loads(infile.read())
+        except (IOError, ValueError) as err:
             print(f"Cannot read given file\n Reason: {err}")
             sys.exit(1)
 
@@ -223,18 +395,27 @@ def main():
         print("No urls to process.")
         sys.exit(1)
 
-    driver = init_driver(args.remember_user, args.driver)
+    if args.workers < 1:
+        parser.error('At least one worker is required.')
+
+    driver = init_driver(args.remember_user, args.driver, args.headless)
     if driver is None:
         sys.exit(1)
 
-    print("\nStarting the main delete loop")
+    # Additional workers reuse the login of the first one
+    drivers = [driver]
+    for _ in range(min(args.workers, len(url_list)) - 1):
+        clone = clone_driver(driver, args.driver, args.headless)
+        if clone is None:
+            break
+        drivers.append(clone)
+
+    print(f"\nStarting the main delete loop with {len(drivers)} worker(s)")
     try:
-        delete_images(driver, url_list)
-        problematic = test_deleted(driver, url_list)
+        problematic = process_parallel(drivers, url_list)
         if problematic:
             print("Several photos could not be deleted. Retrying...")
-            delete_images(driver, problematic)
-            problematic = test_deleted(driver, problematic)
+            problematic = process_parallel(drivers, problematic)
 
             if problematic:
                 print("Cannot delete some photos even after one retry.")
@@ -242,12 +423,14 @@ def main():
                     print(f"  {item}")
 
     except BaseException:
-        # No matter what, always close the driver window.
-        driver.quit()
+        # No matter what, always close the driver windows.
+        for item in drivers:
+            item.quit()
         raise
 
     print("Done")
-    driver.quit()
+    for item in drivers:
+        item.quit()
 
 
 if __name__ == "__main__":
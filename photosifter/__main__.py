@@ -4,12 +4,11 @@ import argparse
 import textwrap
 
 from photosifter import util
-from photosifter import remote
 
 from photosifter.display import MAXIMUM_DISPLAY_SIZE
-from photosifter.downloader import download
-from photosifter.resolver import resolve
-from photosifter.sifter import sift
+
+# Other modules are imported only when needed, as importing the Google API
+# client libraries takes noticeable time and the local mode doesn't need them.
 
 
 def display_guide():
@@ -30,8 +29,9 @@ def display_guide():
             is limited by default. Keyboard shortcuts bellow does not apply to this one.
 
           Download:
-            Pre-download given amount of images from a remote library. Preloading images in
-            remote mode will then work much quicker.
+            Pre-download given amount of original images from a remote library. Remote mode
+            reuses them instead of downloading the images again, so preloading will then work
+            much quicker.
 
           Guide:
             Not really a mode, just this guide.
@@ -107,12 +107,16 @@ def get_parser():
         help="focus threshold for auto choosing (default 0)")
     remote_parser.add_argument("-l", "--backup-maxlen", default=None, type=int,
         help="limit size of the backup buffer")
+    remote_parser.add_argument("--full-size", action='store_true',
+        help="download original images rather than screen sized ones")
 
     # resolver related arguments
     resolve_parser.add_argument("-l", "--limit", type=int, default=1000,
         help="Limit number of photos remotely searched.")
     resolve_parser.add_argument("-d", "--dict", action="store_true",
         help="Print dictionary rather than list of urls.")
+    resolve_parser.add_argument("-c", "--cache", action="store_true",
+        help="Cache listed photos for a day to speed up repeated searches.")
     resolve_parser.add_argument("path",
         help="Path to the to-be-resolved folder.")
 
@@ -135,18 +139,22 @@ def main():
         util.enable_verbose = True
 
     if args.action in ['local', 'remote']:
+        from photosifter.sifter import sift
         sift(args)
 
     elif args.action == 'guide':
         display_guide()
 
     elif args.action == 'resolve':
+        from photosifter.resolver import resolve
         resolve(args)
 
     elif args.action == 'download':
+        from photosifter.downloader import download
         download(args)
 
     if args.forget_user:
+        from photosifter import remote
         remote.forget_credentials()
 
 
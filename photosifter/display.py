@@ -1,4 +1,5 @@
 import enum
+import functools
 
 import cv2
 import numpy
@@ -8,6 +9,48 @@ import numpy
 MAXIMUM_DISPLAY_SIZE = 6
 
 
+# Font and color of the embedded text
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+TEXT_COLOR = (0, 0, 255)
+
+
+@functools.lru_cache(maxsize=32)
+def _text_sprite(text, scale, thickness):
+    """Get pre-rendered text as a color image, its mask and text origin.
+
+    Rasterizing large thick text is quite slow, so each text is drawn just
+    once and then only copied into the displayed images.
+    """
+    (width, height), baseline = cv2.getTextSize(text, FONT, scale, thickness)
+    origin = (thickness, height + thickness)
+
+    mask = numpy.zeros((height + baseline + 2 * thickness, width + 2 * thickness), numpy.uint8)
+    cv2.putText(mask, text, origin, FONT, scale, 255, thickness=thickness)
+
+    sprite = numpy.empty(mask.shape + (3,), numpy.uint8)
+    sprite[:] = TEXT_COLOR
+    return sprite, mask, origin
+
+
+def _draw_text(image, text, position, scale, thickness):
+    """Draw text into the image just like cv2.putText would."""
+    sprite, mask, origin = _text_sprite(text, scale, thickness)
+
+    # Clip the sprite to the image boundaries
+    top = position[1] - origin[1]
+    left = position[0] - origin[0]
+    height, width = mask.shape
+    sprite_top, sprite_left = max(0, -top), max(0, -left)
+    bottom = min(image.shape[0], top + height)
+    right = min(image.shape[1], left + width)
+    if bottom <= top + sprite_top or right <= left + sprite_left:
+        return
+
+    cv2.copyTo(sprite[sprite_top:bottom - top, sprite_left:right - left],
+               mask[sprite_top:bottom - top, sprite_left:right - left],
+               image[top + sprite_top:bottom, left + sprite_left:right])
+
+
 class BORDER(enum.Enum):
     BLUE = [100, 0, 0]
     GREEN = [0, 100, 0]
@@ -22,6 +65,7 @@ class DisplayHandler:
 
         self._enable_text_embeding = True
         self._current = None
+        self._current_key = None
 
         cv2.namedWindow(self.WINDOW_NAME, cv2.WINDOW_NORMAL)
         cv2.resizeWindow(self.WINDOW_NAME, 1280, 640)
@@ -31,10 +75,8 @@ class DisplayHandler:
 
     @staticmethod
     def _embed_text(image, focus, filename):
-        cv2.putText(image, f"Focus: {focus:.2f}", (50, 140),
-                    cv2.FONT_HERSHEY_SIMPLEX, 5, (0, 0, 255), thickness=20)
-        cv2.putText(image, filename, (50, 280),
-                    cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 255), thickness=12)
+        _draw_text(image, f"Focus: {focus:.2f}", (50, 140), 5, 20)
+        _draw_text(image, filename, (50, 280), 3, 12)
 
     def toggle_text_embeding(self):
         self._enable_text_embeding = not self._enable_text_embeding
@@ -61,21 +103,35 @@ class DisplayHandler:
 
     def render(self, image_objects):
 
-        min_height = min(obj.get().shape[0] for obj in image_objects)
+        # Composite doesn't have to be created again if nothing has changed
+        key = (self._enable_text_embeding,
+               tuple((obj.filename, obj.focus) for obj in image_objects))
+        if key == self._current_key:
+            cv2.imshow(self.WINDOW_NAME, self._current)
+            cv2.waitKey(1)
+            return
 
-        complete = None
-        for obj in image_objects:
-
-            image = obj.get(min_height).copy()
-            if self._enable_text_embeding:
-                self._embed_text(image, obj.focus, obj.filename)
-
-            if complete is None:
-                complete = image
-            else:
-                complete = numpy.hstack((complete, image))
+        min_height = min(obj.get().shape[0] for obj in image_objects)
+        resized = [obj.get(min_height) for obj in image_objects]
+
+        # Concatenate all images at once (reusing the previous canvas if
+        # it has the same size) and embed text into the result
+        shape = (min_height, sum(image.shape[1] for image in resized), 3)
+        canvas = self._current if self._current is not None and \
+            self._current.shape == shape else None
+        complete = cv2.hconcat(resized, dst=canvas)
+
+        if self._enable_text_embeding:
+            offset = 0
+            for obj, image in zip(image_objects, resized):
+                # Text is drawn into a view of the image columns only, so
+                # that it is clipped and doesn't spill into the next image
+                width = image.shape[1]
+                self._embed_text(complete[:, offset:offset + width], obj.focus, obj.filename)
+                offset += width
 
         self._current = complete
+        self._current_key = key
 
         cv2.imshow(self.WINDOW_NAME, complete)
         cv2.waitKey(1)  # needed to display the image
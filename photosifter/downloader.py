@@ -20,7 +20,11 @@ def download(args):
         os.makedirs(args.images)
 
     for i, _ in enumerate(range(args.amount)):
-        mediaItem = library.get_next()
+        try:
+            mediaItem = library.get_next()
+        except StopIteration:
+            print("There are no more photos in the library")
+            break
         filename = mediaItem['filename']
 
         print(f"[{i+1}/{args.amount}]: {filename}")
@@ -0,0 +1,128 @@
+import os
+import sqlite3
+import sys
+import threading
+
+from photosifter.util import verbose
+
+
+class FocusCache:
+    """Persistent cache of calculated image focus values.
+
+    Values are saved into a hidden SQLite database inside the image directory
+    and are keyed by the image filename. Each entry also remembers modification
+    time and size of the file so that values of changed files are not used.
+
+    All entries are read into the memory at once and new ones are written
+    back in batches, so that sifting does not wait for the disk.
+    """
+
+    FILENAME = ".photosifter_focus.db"
+
+    # Must be increased with every change of the focus calculation
+    VERSION = 4
+
+    # Number of new entries written to the database at once
+    BATCH_SIZE = 64
+
+    def __init__(self, path):
+        """Initialize focus cache for images in the given directory.
+
+        Args:
+            path: path to the directory with images.
+        """
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._unsaved = []
+        self._connection = None
+
+        try:
+            # Entries are set by worker threads (guarded by the lock)
+            self._connection = sqlite3.connect(
+                os.path.join(path, self.FILENAME), check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+
+            version, = self._connection.execute("PRAGMA user_version").fetchone()
+            if version != self.VERSION:
+                self._connection.execute("DROP TABLE IF EXISTS focus")
+                self._connection.execute(f"PRAGMA user_version={self.VERSION}")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS focus "
+                "(name TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, focus REAL)")
+
+            for name, mtime, size, focus in self._connection.execute("SELECT * FROM focus"):
+                self._entries[name] = (mtime, size, focus)
+            verbose(f"Focus cache: loaded {len(self._entries)} entries")
+        except sqlite3.Error as err:
+            verbose(f"Focus cache: cannot be loaded: {err}")
+            self._connection = None
+
+    @staticmethod
+    def _signature(filepath, stat=None):
+        if stat is None:
+            stat = os.stat(filepath)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, filepath, stat=None):
+        """Get cached focus of given image file or None if unknown.
+
+        Already known stat result of the file can be given to avoid another
+        stat call.
+        """
+
+        with self._lock:
+            entry = self._entries.get(os.path.basename(filepath))
+        if entry is None:
+            return None
+
+        try:
+            if entry[:2] != self._signature(filepath, stat):
+                return None
+        except OSError:
+            return None
+        return entry[2]
+
+    def set(self, filepath, focus):
+        """Remember focus of given image file."""
+
+        try:
+            entry = self._signature(filepath) + (focus,)
+        except OSError:
+            return
+
+        name = os.path.basename(filepath)
+        with self._lock:
+            self._entries[name] = entry
+            self._unsaved.append((name,) + entry)
+            if len(self._unsaved) >= self.BATCH_SIZE:
+                self._write()
+
+    def _write(self):
+        """Write unsaved entries into the database (lock must be held)."""
+
+        if self._connection is None or not self._unsaved:
+            return
+
+        try:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO focus VALUES (?, ?, ?, ?)", self._unsaved)
+            self._unsaved = []
+        except sqlite3.Error as err:
+            sys.stderr.write(f"Cannot save focus cache.\n{err}\n")
+            self._connection = None
+
+    def save(self):
+        """Save the rest of the cache back into the image directory.
+
+        The database is closed afterwards, so that no temporary files remain
+        in the image directory.
+        """
+
+        with self._lock:
+            self._write()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
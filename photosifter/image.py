@@ -1,39 +1,249 @@
+import http.client
 import os
+import sys
+import threading
+from collections import OrderedDict
+from urllib.error import HTTPError
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+from urllib.request import getproxies
+from urllib.request import proxy_bypass
 from urllib.request import urlopen
 
 import cv2
+import numpy
+
+
+# Length of the shorter image side used for the focus calculation
+FOCUS_SIZE = 512
+
+# Reduced grayscale decode modes (by their scale) used for the focus
+# calculation. JPEG decoder scales these directly in the DCT domain, which
+# is several times faster than decoding the whole image and resizing it.
+FOCUS_READ_FLAGS = {
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    1: cv2.IMREAD_GRAYSCALE,
+}
+
+# Maximum amount of memory used by all loaded (full size) images together
+LOADED_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Maximum amount of memory used by all resized images together
+RESIZED_CACHE_SIZE = 512 * 1024 * 1024
+
+
+class ImageCache:
+    """LRU cache of images shared by all Image objects.
+
+    Images are keyed by (filename, height) and the least recently used ones
+    are evicted once their total size exceeds the given byte budget.
+    """
+
+    def __init__(self, budget):
+        self._budget = budget
+        self._images = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get cached image with given key or None."""
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key, image):
+        """Insert new image into the cache, evicting the old ones if needed."""
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self._size -= old.nbytes
+
+            self._images[key] = image
+            self._size += image.nbytes
+
+            # Never evict the inserted image itself
+            while self._size > self._budget and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._size -= evicted.nbytes
+
+    def evict(self, filename):
+        """Remove all sizes of given image from the cache."""
+        with self._lock:
+            for key in [key for key in self._images if key[0] == filename]:
+                self._size -= self._images.pop(key).nbytes
+
+
+# Original images are stored with None height
+loaded_cache = ImageCache(LOADED_CACHE_SIZE)
+resized_cache = ImageCache(RESIZED_CACHE_SIZE)
+
+# Per thread scratch buffers for intermediate results
+_scratch = threading.local()
+
+
+def get_scratch(name, shape, dtype):
+    """Get reusable buffer of given shape and type owned by current thread."""
+    buffer = getattr(_scratch, name, None)
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = numpy.empty(shape, dtype=dtype)
+        setattr(_scratch, name, buffer)
+    return buffer
+
+
+# Per thread persistent HTTP connections (by scheme and host)
+_connections = threading.local()
+
+# Size of chunks in which the downloaded content is written into a file
+CHUNK_SIZE = 64 * 1024
+
+# Timeout of blocking network operations (in seconds), so that stalled
+# connections don't block workers forever
+HTTP_TIMEOUT = 30
+
+
+def _read_response(response, dst):
+    """Read content of given response (or stream it into dst file)."""
+    if dst is None:
+        return response.read()
+    for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+        dst.write(chunk)
+    return None
+
+
+def http_get(url, redirects=5, dst=None):
+    """Download content of given URL (following up to given number of
+    redirects).
+
+    If a binary file object dst is given, content is streamed into it in
+    chunks (instead of being held in memory as a whole) and None is returned.
+
+    Connections are kept alive and reused by following requests from the
+    same thread, which saves TCP and TLS handshake for each image. If there
+    is a proxy configured for the URL, urlopen is used instead.
+    """
+    parts = urlsplit(url)
+    if parts.scheme in getproxies() and not proxy_bypass(parts.hostname):
+        with urlopen(url, timeout=HTTP_TIMEOUT) as response:
+            return _read_response(response, dst)
+
+    path = f"{parts.path}?{parts.query}" if parts.query else parts.path
+    key = (parts.scheme, parts.netloc)
+
+    pool = getattr(_connections, 'pool', None)
+    if pool is None:
+        pool = _connections.pool = {}
+
+    # Connection can be closed by the server meanwhile, retry once with new one
+    for attempt in range(2):
+        connection = pool.get(key)
+        if connection is None:
+            if parts.scheme == 'https':
+                connection = http.client.HTTPSConnection(parts.netloc, timeout=HTTP_TIMEOUT)
+            else:
+                connection = http.client.HTTPConnection(parts.netloc, timeout=HTTP_TIMEOUT)
+            pool[key] = connection
+
+        try:
+            connection.request('GET', path or '/')
+            response = connection.getresponse()
+            if dst is None or response.status != 200:
+                content = response.read()
+            else:
+                # Discard anything written by the failed attempt
+                dst.seek(0)
+                dst.truncate()
+                content = _read_response(response, dst)
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            del pool[key]
+            if attempt:
+                raise
+            continue
+
+        location = response.getheader('Location')
+        if response.status in (301, 302, 303, 307, 308) and location and redirects:
+            return http_get(urljoin(url, location), redirects - 1, dst)
+        if response.status != 200:
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        return content
+
+
+def local_filename(path, filename, size):
+    """Get filename of the image downloaded scaled down to given maximum
+    (width, height) size (original filename if size is None).
+
+    Scaled images are stored under different names, so that they are never
+    mistaken for the original ones. Original image already downloaded into
+    the given directory is used instead of the scaled one.
+    """
+    if size is None:
+        return filename
+    filepath = os.path.join(path, filename)
+    if os.path.isfile(filepath) and os.path.getsize(filepath):
+        return filename
+    name, ext = os.path.splitext(filename)
+    return f"{name}.w{size[0]}-h{size[1]}{ext}"
 
 
 class Image:
 
-    def __init__(self, filename, path, mediaItem=None):
+    def __init__(self, filename, path, mediaItem=None, focus_cache=None, stat=None,
+                 download_size=None):
 
         self._mediaItem = mediaItem
+        # Maximum (width, height) of the downloaded image (None for original)
+        self._download_size = download_size
+        self._focus_cache = focus_cache
         self._filename = filename
         self._path = path
 
         filepath = os.path.join(path, filename)
-        # consider file not downloaded if its size is zero
-        self._downloaded = os.path.isfile(filepath) and os.path.getsize(filepath)
+        # consider file not downloaded if its size is zero (stat result of
+        # the file can be given if it is already known)
+        if stat is None:
+            self._downloaded = os.path.isfile(filepath) and os.path.getsize(filepath)
+        else:
+            self._downloaded = stat.st_size > 0
         self._deleted = False
+        # Set when the download fails, so that it is not retried
+        self._failed = False
+
+        # Use previously calculated focus if available
         self._focus = None
-        self._base_image = None
-        self._image_map = {}
+        if focus_cache is not None and self._downloaded:
+            self._focus = focus_cache.get(filepath, stat)
 
-    def __lt__(self, other):
-        """Note: This comparator is here to keep deque from throwing type errors
-        when two objects with the same priority are given. We don't really care
-        which one of them will be processed first, so no real comparison occurs.
-        """
-        return True
+        # Image can be loaded by several threads at once
+        self._lock = threading.Lock()
 
     def download_image(self):
         if self._downloaded:
             return
 
-        with urlopen(f"{self._mediaItem['baseUrl']}=d") as src:
-            with open(os.path.join(self._path, self._mediaItem['filename']), 'wb') as dst:
-                dst.write(src.read())
+        # Content is streamed into a temporary file first, so that partially
+        # downloaded images are never mistaken for complete ones.
+        # Google Photos can scale the image down on the server side, which
+        # saves both network transfer and decoding time.
+        if self._download_size is None:
+            url = f"{self._mediaItem['baseUrl']}=d"
+        else:
+            width, height = self._download_size
+            url = f"{self._mediaItem['baseUrl']}=w{width}-h{height}"
+
+        filepath = os.path.join(self._path, self._filename)
+        try:
+            with open(f"{filepath}.part", 'wb') as dst:
+                http_get(url, dst=dst)
+            os.replace(f"{filepath}.part", filepath)
+        except BaseException:
+            try:
+                os.remove(f"{filepath}.part")
+            except OSError:
+                pass
+            raise
         self._downloaded = True
 
     def load_image(self, focus_only: bool = False):
@@ -41,43 +251,90 @@ class Image:
 
         If focus_only is True, the image itself is not saved and only focus
         is calculated. Image is not deloaded if it was already saved.
-        """
 
-        def _load_image(path, filename):
-            """Get image object or None from given path and filename."""
-            return cv2.imread(os.path.join(path, filename))
-
-        def _get_image_focus(image):
-            """Get focus value of given image."""
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            return cv2.Laplacian(gray, cv2.CV_64F).var()
-
-        # Download image if it is not yet downloaded
-        if not self._downloaded:
-            self.download_image()
-
-        # Do nothing if image is deleted
-        if self._deleted:
-            return
-
-        # Nothing to load if base image already exists
-        if self._base_image is not None:
-            return
+        If the image is being loaded by another thread, this waits for it to
+        finish instead of loading the same image twice.
 
-        # Nothing to do if focus was already calculated
-        if focus_only and self._focus is not None:
-            return
-
-        image = _load_image(self._path, self._filename)
-        self._focus = _get_image_focus(image)
+        Loaded image is returned (None if focus_only is True or the image is
+        deleted or its download failed).
+        """
 
-        if not focus_only:
-            self._base_image = image
+        def _load_image(path, filename, flags=cv2.IMREAD_COLOR):
+            """Get image object or None from given path and filename."""
+            return cv2.imread(os.path.join(path, filename), flags)
+
+        def _get_image_focus(gray):
+            """Get focus value of given grayscale image."""
+
+            # Variance of the Laplacian is robust to scaling, and working with
+            # images of the same size keeps values comparable between them.
+            scale = FOCUS_SIZE / min(gray.shape)
+            if scale < 1:
+                gray = cv2.resize(gray, None, fx=scale, fy=scale,
+                                  interpolation=cv2.INTER_AREA)
+
+            # Reuse the filter output buffer instead of allocating it each time.
+            # Laplacian of 8-bit image always fits into 16-bit integers, which
+            # halves the memory traffic compared to floats.
+            laplacian = get_scratch('laplacian', gray.shape, numpy.int16)
+            cv2.Laplacian(gray, cv2.CV_16S, dst=laplacian)
+            # Variance computed by OpenCV in a single pass (no numpy temporaries)
+            _, stddev = cv2.meanStdDev(laplacian)
+            return float(stddev[0, 0]) ** 2
+
+        with self._lock:
+
+            # Do nothing if image is deleted or cannot be downloaded
+            if self._deleted or self._failed:
+                return None
+
+            # Download image if it is not yet downloaded
+            if not self._downloaded:
+                try:
+                    self.download_image()
+                except (HTTPError, http.client.HTTPException, OSError) as err:
+                    sys.stderr.write(f"Cannot download '{self._filename}'.\n{err}\n")
+                    self._failed = True
+                    return None
+
+            # Nothing to load if base image already exists
+            image = loaded_cache.get((self._filename, None))
+            if image is not None:
+                return None if focus_only else image
+
+            # Nothing to do if focus was already calculated
+            if focus_only and self._focus is not None:
+                return None
+
+            # Focus is always calculated from the reduced grayscale decode
+            # (even if the full image is loaded as well), because values
+            # obtained from differently decoded images are not comparable.
+            if self._focus is None:
+                # Color information is not needed at all for the focus, so
+                # let the decoder produce grayscale image directly. Try the
+                # most reduced one first and if it is too small, decode again
+                # with the smallest reduction still large enough.
+                gray = _load_image(self._path, self._filename, FOCUS_READ_FLAGS[4])
+                if gray is not None and min(gray.shape) < FOCUS_SIZE:
+                    scale = 2 if 2 * min(gray.shape) >= FOCUS_SIZE else 1
+                    gray = _load_image(self._path, self._filename, FOCUS_READ_FLAGS[scale])
+
+                self._focus = _get_image_focus(gray)
+                if self._focus_cache is not None:
+                    self._focus_cache.set(os.path.join(self._path, self._filename), self._focus)
+
+            if focus_only:
+                return None
+
+            image = _load_image(self._path, self._filename)
+            loaded_cache.put((self._filename, None), image)
+            return image
 
     def deload_image(self):
         """Deload image (in all sizes) from the application memory"""
-        self._base_image = None
-        self._image_map = {}
+        with self._lock:
+            loaded_cache.evict(self._filename)
+        resized_cache.evict(self._filename)
 
     def get(self, height=None):
         """Get image itself, optionally with specified height.
@@ -87,26 +344,34 @@ class Image:
 
         If the image itself exists, this method is guaranteed to succeed
         no matter of the current state object (download and load are
-        done if necessary).
+        done if necessary). None is returned for images which failed to
+        download.
         """
 
-        # Load image if it is not loaded
-        if self._base_image is None:
-            self.load_image()
+        # Load image if it is not loaded (or was evicted meanwhile)
+        image = loaded_cache.get((self._filename, None))
+        if image is None:
+            image = self.load_image()
+            # Nothing to return if the download failed
+            if image is None:
+                return None
 
         # Return original image if no height was specified
         if height is None:
-            return self._base_image
+            return image
 
-        # Return cached image from the image map
-        if height in self._image_map:
-            return self._image_map[height]
+        # Return cached image from the resized cache
+        resized = resized_cache.get((self._filename, height))
+        if resized is not None:
+            return resized
 
-        current_height, current_width, _ = self._base_image.shape
+        current_height, current_width, _ = image.shape
         new_width = int((height / current_height) * current_width)
-        resized = cv2.resize(self._base_image, (new_width, height))
+        # Area interpolation is both faster and better looking for downscaling
+        interpolation = cv2.INTER_AREA if height < current_height else cv2.INTER_LINEAR
+        resized = cv2.resize(image, (new_width, height), interpolation=interpolation)
 
-        self._image_map[height] = resized
+        resized_cache.put((self._filename, height), resized)
         return resized
 
     def delete(self):
@@ -154,6 +419,10 @@ class Image:
     def deleted(self):
         return self._deleted
 
+    @property
+    def failed(self):
+        return self._failed
+
     @property
     def focus(self):
         return self._focus
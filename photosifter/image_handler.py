@@ -1,14 +1,20 @@
 import enum
 import json
 import os
-import queue
 import threading
 import time
 
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
+from photosifter import util
 from photosifter.util import verbose
 from photosifter.image import Image
+from photosifter.image import local_filename
+
+
+# Translation table making dots the lowest characters when sorting filenames
+SORT_TABLE = str.maketrans({'.': chr(0x01)})
 
 
 class JOB(enum.Enum):
@@ -20,26 +26,159 @@ class JOB(enum.Enum):
     EXIT = 3
 
 
+class LazyImages(dict):
+    """Map of Image objects which are created on the first access.
+
+    Directory entries of the images are kept, so that their (cached) stat
+    results can be reused.
+    """
+
+    def __init__(self, path, entries, focus_cache=None):
+        dict.__init__(self)
+        self._path = path
+        self._entries = entries
+        self._focus_cache = focus_cache
+
+    def _stat(self, entry):
+        try:
+            return entry.stat() if entry is not None else None
+        except OSError:
+            return None
+
+    def __missing__(self, filename):
+        stat = self._stat(self._entries.pop(filename, None))
+        image = Image(filename, self._path, focus_cache=self._focus_cache, stat=stat)
+        self[filename] = image
+        return image
+
+    def has_focus(self, filename):
+        """Whether focus of given image is already known (without creating
+        the Image object if it doesn't exist yet)."""
+        if filename in self:
+            return self[filename].focus is not None
+        if self._focus_cache is None:
+            return False
+
+        stat = self._stat(self._entries.get(filename))
+        if stat is None or not stat.st_size:
+            return False
+        return self._focus_cache.get(os.path.join(self._path, filename), stat) is not None
+
+
+class JobQueue:
+    """Two level queue of background worker jobs.
+
+    Urgent jobs (loading and downloading of images close to the current
+    view) are always served before the background ones (focus calculation).
+    Both levels are simple FIFO queues guarded by a single lock.
+
+    Workers serving only urgent jobs wait on their own condition, so that
+    every new job wakes up exactly one worker able to process it.
+    """
+
+    def __init__(self):
+        self._urgent = deque()
+        self._background = deque()
+        self._closed = False
+
+        lock = threading.Lock()
+        self._condition = threading.Condition(lock)
+        self._urgent_condition = threading.Condition(lock)
+        # Number of urgent only workers waiting (and not yet notified)
+        self._urgent_waiting = 0
+
+        # Jobs (with Image objects) currently waiting in the queue
+        self._pending = set()
+
+    def put(self, job, obj=None, urgent=True):
+        """Add new job for given Image object (can be None).
+
+        Job for an Image object is not added again if the very same one is
+        already waiting in the queue.
+        """
+        self.put_many([(job, obj)], urgent)
+
+    def put_many(self, jobs, urgent=True):
+        """Add several (job, obj) pairs at once, same as put would."""
+        queue = self._urgent if urgent else self._background
+        with self._condition:
+            for job, obj in jobs:
+                if obj is not None:
+                    if (job, obj) in self._pending:
+                        continue
+                    self._pending.add((job, obj))
+
+                queue.append((job, obj))
+
+                if urgent and self._urgent_waiting:
+                    self._urgent_waiting -= 1
+                    self._urgent_condition.notify()
+                else:
+                    self._condition.notify()
+
+    def get(self, urgent_only=False):
+        """Get next job, waiting for one if there is none.
+
+        If urgent_only is True, background jobs are never returned.
+
+        Once the queue is closed, EXIT job is returned immediately and all
+        remaining jobs are dropped.
+        """
+        with self._condition:
+            while True:
+                ready = self._urgent or (self._background and not urgent_only)
+                if self._closed or ready:
+                    break
+                if urgent_only:
+                    self._urgent_waiting += 1
+                    self._urgent_condition.wait()
+                else:
+                    self._condition.wait()
+
+            if self._closed:
+                return JOB.EXIT, None
+            if self._urgent:
+                item = self._urgent.popleft()
+            else:
+                item = self._background.popleft()
+
+            self._pending.discard(item)
+            return item
+
+    def close(self):
+        """Close the queue and wake up all waiting workers."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            self._urgent_condition.notify_all()
+
+
 class Worker(threading.Thread):
     """Background worker class."""
 
-    def __init__(self, job_queue):
+    def __init__(self, job_queue, urgent_only=False):
         """Initialize background image preloading thread.
 
         Args:
-            job_queue: priority queue with worker jobs
+            job_queue: JobQueue object with worker jobs
+            urgent_only: whether the worker serves only urgent jobs.
         """
         threading.Thread.__init__(self)
 
         self._queue = job_queue
+        self._urgent_only = urgent_only
         self._download_capable = False
 
         self._filenames = None
         self._images = None
         self._path = None
         self._library = None
+        self._download_lock = None
+        self._download_slots = None
+        self._download_size = None
 
-    def enable_downloading(self, filenames, images, path, library):
+    def enable_downloading(self, filenames, images, path, library, lock, slots,
+                           download_size=None):
         """Enable download capability of the Worker
 
         To download images and create new Image objects, the worker needs to
@@ -52,11 +191,19 @@ class Worker(threading.Thread):
             images: main map of Image objects.
             path: download path of all new images.
             library: GooglePhotosLibrary object.
+            lock: lock shared by all downloading workers.
+            slots: semaphore limiting the number of queued downloads, which
+                is released after each processed download.
+            download_size: maximum (width, height) of downloaded images or
+                None for the original ones.
         """
         self._filenames = filenames
         self._images = images
         self._path = path
         self._library = library
+        self._download_lock = lock
+        self._download_slots = slots
+        self._download_size = download_size
 
         self._download_capable = True
 
@@ -64,13 +211,14 @@ class Worker(threading.Thread):
         """Worker thread run method"""
 
         while True:
-            _, item = self._queue.get()
-            job, obj = item
+            job, obj = self._queue.get(self._urgent_only)
 
-            if obj is not None:
-                verbose(f"Background job: {job.name} : {obj.filename}")
-            else:
-                verbose(f"Background job: {job.name}")
+            # don't even format the messages if they wouldn't be printed
+            if util.enable_verbose:
+                if obj is not None:
+                    verbose(f"Background job: {job.name} : {obj.filename}")
+                else:
+                    verbose(f"Background job: {job.name}")
 
             # stop thread and return back to main one
             if job is JOB.EXIT:
@@ -82,16 +230,30 @@ class Worker(threading.Thread):
                     print("Did you forget to call enable_downloading func?")
                     continue
 
-                mediaItem = self._library.get_next()
-                filename = mediaItem['filename']
-
-                verbose(f"Background job: {job.name} : {filename}")
-
-                obj = Image(filename, self._path, mediaItem)
-                obj.load_image()
-
-                self._images[filename] = obj
-                self._filenames.append(filename)
+                # Image is added into the carousel before it is downloaded
+                # (under the lock, so that images remain in the library order)
+                # and other workers can download the following ones meanwhile.
+                # Main thread waits for the download if it needs the image
+                # (and removes it from the carousel if the download failed).
+                try:
+                    with self._download_lock:
+                        try:
+                            mediaItem = self._library.get_next()
+                        except StopIteration:
+                            # every photo of the library is already there
+                            continue
+                        filename = local_filename(self._path, mediaItem['filename'],
+                                                  self._download_size)
+
+                        obj = Image(filename, self._path, mediaItem,
+                                    download_size=self._download_size)
+                        self._images[filename] = obj
+                        self._filenames.append(filename)
+
+                    verbose(f"Background job: {job.name} : {filename}")
+                    obj.load_image()
+                finally:
+                    self._download_slots.release()
 
             # preload image itself
             elif job is JOB.LOAD_IMAGE:
@@ -113,6 +275,12 @@ class BaseImageHandler:
 
     PRELOAD_RANGE = 10
 
+    # Number of background worker threads
+    WORKER_COUNT = 1
+
+    # Number of additional workers reserved for urgent jobs only
+    URGENT_WORKER_COUNT = 0
+
     def __init__(self, path, filenames, images, with_threading=True, backup_maxlen=None):
         """Initialize image handler class.
 
@@ -128,7 +296,7 @@ class BaseImageHandler:
         """
 
         self._idx = 0
-        self._worker = None
+        self._workers = []
         self._job_queue = None
         self._backup = deque(maxlen=backup_maxlen)
 
@@ -140,7 +308,7 @@ class BaseImageHandler:
             self._start_worker()
 
     def __del__(self):
-        if self._worker:
+        if self._workers:
             self._end_worker()
 
     def __len__(self):
@@ -165,18 +333,31 @@ class BaseImageHandler:
         return self.__getitem__(self._idx + idx)
 
     def _load(self, idx):
-        if self._worker is None:
+        if not self._workers:
             return
 
         if 0 <= idx <= len(self._filenames) - 2:
             verbose(f'Main: load image {idx}')
-            self._job_queue.put((5, (JOB.LOAD_IMAGE, self.__getitem__(idx))))
+            self._job_queue.put(JOB.LOAD_IMAGE, self.__getitem__(idx))
 
     def _deload(self, idx):
-        if 0 <= idx <= len(self._filenames) - 2:
+        if 0 <= idx < len(self._filenames):
             verbose(f'Main: deload image {idx}')
             self.__getitem__(idx).deload_image()
 
+    def preload_neighbours(self, amount):
+        """Preload images just outside of the current view of given size.
+
+        These are the ones that will be displayed after the next roll, so
+        they are loaded while main thread waits for user input.
+        """
+        if not self._workers:
+            return
+
+        for idx in (self._idx - 1, self._idx + amount):
+            if 0 <= idx < len(self._filenames):
+                self._job_queue.put(JOB.LOAD_IMAGE, self.__getitem__(idx))
+
     def roll_right(self):
         """Move the image carousel one image to the right"""
         if self._idx <= 0:
@@ -210,7 +391,7 @@ class BaseImageHandler:
         except IndexError:
             return None
 
-        self._backup.append((idx, obj))
+        self._backup.append((idx, obj.filename))
 
         del self._filenames[idx]
         obj.delete()
@@ -230,50 +411,81 @@ class BaseImageHandler:
     def restore_last(self):
         """Restore last deleted image."""
         try:
-            idx, obj = self._backup.pop()
+            idx, filename = self._backup.pop()
         except IndexError:
             return None
 
-        filename = obj.filename
         self._filenames.insert(idx, filename)
         self._images[filename].restore()
         return filename
 
     def get_list(self, amount):
-        """Get 'amount' images from current view."""
-        objects = []
-        try:
-            for i in range(amount):
-                objects.append(self.__getitem__(self._idx + i))
-        except IndexError:
-            pass
+        """Get 'amount' images from current view.
 
+        Images which failed to download are removed from the carousel here
+        (by the main thread), so that the view and offsets used by keys
+        always match.
+        """
+        objects = []
+        idx = self._idx
+        while len(objects) < amount and idx < len(self._filenames):
+            obj = self.__getitem__(idx)
+            # This also waits for the download if it is in progress
+            if obj.get() is None and obj.failed:
+                del self._filenames[idx]
+                continue
+            objects.append(obj)
+            idx += 1
+
+        # Move the view back if images at its end were removed
+        if not objects and self._idx > 0 and self._idx >= len(self._filenames):
+            self._idx = max(0, len(self._filenames) - 1)
+            return self.get_list(amount)
         return objects
 
     def _start_worker(self):
-        """Start background worker."""
-        self._job_queue = queue.PriorityQueue()
-        self._worker = Worker(self._job_queue)
-        self._worker.start()
+        """Start background workers."""
+        self._job_queue = JobQueue()
+        self._workers = [Worker(self._job_queue) for _ in range(self.WORKER_COUNT)]
+        self._workers += [Worker(self._job_queue, urgent_only=True)
+                          for _ in range(self.URGENT_WORKER_COUNT)]
+        for worker in self._workers:
+            worker.start()
 
     def _end_worker(self):
-        """Stop background worker."""
-        self._job_queue.put((0, (JOB.EXIT, None)))
-        self._worker.join()
+        """Stop background workers."""
+        self._job_queue.close()
+        for worker in self._workers:
+            worker.join()
 
 
 class ImageHandler(BaseImageHandler):
 
     # All allowed image extensions
-    ALLOWED_IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg')
+    ALLOWED_IMAGE_EXTENSIONS = {'.jpg', '.png', '.jpeg'}
 
-    def __init__(self, path, with_threading=True, backup_maxlen=None):
+    # Image decoding and focus calculation release the GIL, so local images
+    # can be processed on all cores at once (more workers than that would
+    # mostly compete for the disk and memory bandwidth).
+    WORKER_COUNT = min(8, os.cpu_count() or 1)
+
+    # Images requested by the view are never stuck behind focus calculations
+    URGENT_WORKER_COUNT = 1
+
+    @classmethod
+    def _is_image(cls, entry):
+        """Whether given directory entry is an image file of allowed type."""
+        extension = os.path.splitext(entry.name)[1].lower()
+        return extension in cls.ALLOWED_IMAGE_EXTENSIONS and entry.is_file()
+
+    def __init__(self, path, with_threading=True, backup_maxlen=None, focus_cache=None):
         """Initialize image handler class.
 
         Args:
             path: path to the directory with images.
             with_threading: whether to enable background image preloading.
             backup_maxlen: maximum size of the backup queue.
+            focus_cache: optional FocusCache object shared by all images.
 
         This handler is used for locally saved images.
 
@@ -282,16 +494,14 @@ class ImageHandler(BaseImageHandler):
         alphabetically and only contains files with allowed extensions.
         """
 
-        files = os.listdir(path)  # Throws IOError
-        filenames = [
-            file
-            for file in files
-            if file.lower().endswith(self.ALLOWED_IMAGE_EXTENSIONS)
-        ]
-        images = {filename: Image(filename, path) for filename in filenames}
+        with os.scandir(path) as entries:  # Throws IOError
+            image_entries = {entry.name: entry for entry in entries if self._is_image(entry)}
 
-        # NOTE: This way of sorting might not be the most efficient, but it works well
-        filenames.sort(key=lambda item: item.replace('.', chr(0x01)))
+        # Dots are sorted before any other character (so that 'a.jpg' < 'a_1.jpg')
+        keyed = sorted((filename.translate(SORT_TABLE), filename) for filename in image_entries)
+        filenames = [filename for _, filename in keyed]
+        # Image objects are created only for images which are really used
+        images = LazyImages(path, image_entries, focus_cache)
 
         BaseImageHandler.__init__(self, path, filenames, images, with_threading, backup_maxlen)
 
@@ -299,24 +509,42 @@ class ImageHandler(BaseImageHandler):
         """Start background worker."""
         BaseImageHandler._start_worker(self)
 
-        # fill queue with focus jobs and non loaded images
-        size = len(self._images)
-        for i, filename in enumerate(self._filenames):
-            self._job_queue.put((size + i, (JOB.CALC_FOCUS, self.__getitem__(filename))))
+        # fill queue with non loaded images first (so that idle workers start
+        # with them) and then with focus jobs for images without cached value
+        self._job_queue.put_many(
+            (JOB.LOAD_IMAGE, self.__getitem__(i))
+            for i in range(2, min(self.PRELOAD_RANGE + 1, len(self._filenames))))
 
-        for i in range(2, min(self.PRELOAD_RANGE + 1, len(self._filenames))):
-            self._job_queue.put((i, (JOB.LOAD_IMAGE, self.__getitem__(i))))
+        # build the whole list first so that the queue isn't locked meanwhile
+        # (Image objects are created only for images without cached focus)
+        focus_jobs = [(JOB.CALC_FOCUS, self.__getitem__(filename))
+                      for filename in self._filenames
+                      if not self._images.has_focus(filename)]
+        self._job_queue.put_many(focus_jobs, urgent=False)
 
 
 class RemoteImageHandler(BaseImageHandler):
 
-    def __init__(self, path, library, backup_maxlen=None):
+    # Downloads are mostly waiting for the network, but too many concurrent
+    # ones could exceed request limits of the Google Photos service.
+    WORKER_COUNT = 3
+
+    # Number of concurrent downloads of the images shown at the start
+    INITIAL_DOWNLOADS = 4
+
+    # Maximum size of downloaded images, which is enough to fill the whole
+    # screen with a single image.
+    DOWNLOAD_SIZE = (2560, 1440)
+
+    def __init__(self, path, library, backup_maxlen=None, full_size=False):
         """Initialize image handler class.
 
         Args:
             path: path to the directory with images.
             library: GooglePhotosLibrary object.
             backup_maxlen: maximum size of the backup queue.
+            full_size: whether to download original images instead of those
+                scaled down to the DOWNLOAD_SIZE.
 
         This handler is used for remotely saved images.
 
@@ -327,6 +555,9 @@ class RemoteImageHandler(BaseImageHandler):
         """
 
         self._library = library
+        self._download_size = None if full_size else self.DOWNLOAD_SIZE
+        # Limits the number of queued and running downloads
+        self._download_slots = threading.Semaphore(self.PRELOAD_RANGE)
         filenames = []
         images = {}
 
@@ -334,12 +565,16 @@ class RemoteImageHandler(BaseImageHandler):
             os.makedirs(path)
 
         for mediaItem in self._library.get_multiple(10):
-            filename = mediaItem['filename']
+            filename = local_filename(path, mediaItem['filename'], self._download_size)
             filenames.append(filename)
+            images[filename] = Image(filename, path, mediaItem,
+                                     download_size=self._download_size)
 
-            image = Image(filename, path, mediaItem)
-            image.download_image()
-            images[filename] = image
+        # Download the first images in parallel, as download is mostly waiting
+        # for the network
+        with ThreadPoolExecutor(max_workers=self.INITIAL_DOWNLOADS) as executor:
+            for _ in executor.map(Image.download_image, images.values()):
+                pass
 
         BaseImageHandler.__init__(self, path, filenames, images, True, backup_maxlen)
 
@@ -362,18 +597,23 @@ class RemoteImageHandler(BaseImageHandler):
                 json.dump(deleted, outfile)
 
     def _start_worker(self):
-        """Start background worker."""
+        """Start background workers."""
         BaseImageHandler._start_worker(self)
-        self._worker.enable_downloading(self._filenames, self._images,
-                                        self._path, self._library)
+        download_lock = threading.Lock()
+        for worker in self._workers:
+            worker.enable_downloading(self._filenames, self._images, self._path,
+                                      self._library, download_lock, self._download_slots,
+                                      self._download_size)
 
-        for i in range(2, min(self.PRELOAD_RANGE + 1, len(self._filenames))):
-            self._job_queue.put((i, (JOB.LOAD_IMAGE, self.__getitem__(i))))
+        self._job_queue.put_many(
+            (JOB.LOAD_IMAGE, self.__getitem__(i))
+            for i in range(2, min(self.PRELOAD_RANGE + 1, len(self._filenames))))
 
     def _load(self, idx):
         BaseImageHandler._load(self, idx)
 
         # Add remote download job if index is out of range on the right side
-        if idx > len(self._filenames) - 2:
+        # (unless there are already enough of them waiting or in progress)
+        if idx > len(self._filenames) - 2 and self._download_slots.acquire(blocking=False):
             verbose(f'Main: download image {idx}')
-            self._job_queue.put((10, (JOB.DOWNLOAD_IMAGE, None)))
+            self._job_queue.put(JOB.DOWNLOAD_IMAGE)
@@ -1,31 +1,112 @@
+import hashlib
+import json
 import os
+import random
+import shutil
+import sys
+import time
 from argparse import Namespace
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
 
 from photosifter.util import AUTH_BASE
+from photosifter.util import CACHE_BASE
 
 
 # Get absolute paths to auth related files
 credentials_file = os.path.join(AUTH_BASE, "token.json")
 client_secret_file = os.path.join(AUTH_BASE, "client_secret.json")
 
+# Cached pages of media items and how long they are valid (in seconds)
+PAGE_CACHE_DIR = os.path.join(CACHE_BASE, "pages")
+PAGE_CACHE_TTL = 24 * 60 * 60
+
+# Discovery document describing the Photos Library API and its local copy
+# (it changes rarely, so it is downloaded again only once a week)
+DISCOVERY_URL = "https://photoslibrary.googleapis.com/$discovery/rest?version=v1"
+DISCOVERY_FILE = os.path.join(CACHE_BASE, "photoslibrary-v1.json")
+DISCOVERY_TTL = 7 * 24 * 60 * 60
+
+
+def get_discovery_document():
+    """Get discovery document of the Photos Library API (cached on the disk)."""
+    try:
+        if time.time() - os.path.getmtime(DISCOVERY_FILE) < DISCOVERY_TTL:
+            with open(DISCOVERY_FILE, 'r') as infile:
+                return infile.read()
+    except OSError:
+        pass
+
+    try:
+        with urlopen(DISCOVERY_URL) as response:
+            document = response.read().decode()
+    except OSError:
+        # Use outdated document rather than nothing
+        if os.path.isfile(DISCOVERY_FILE):
+            with open(DISCOVERY_FILE, 'r') as infile:
+                return infile.read()
+        raise
+
+    try:
+        os.makedirs(CACHE_BASE, exist_ok=True)
+        with open(DISCOVERY_FILE, 'w') as outfile:
+            outfile.write(document)
+    except OSError:
+        pass
+    return document
+
 
 def forget_credentials():
     if os.path.isfile(credentials_file):
         print("Forgetting current user")
         os.remove(credentials_file)
 
+    # Cached media items belong to the forgotten user as well
+    shutil.rmtree(PAGE_CACHE_DIR, ignore_errors=True)
+
+
+def get_page_size(maximum=100):
+    """Get page size set by PHOTOSIFTER_PAGE_SIZE environment variable
+    (limited to 1 - maximum) or the maximum if it is unset or invalid."""
+    value = os.environ.get('PHOTOSIFTER_PAGE_SIZE')
+    if value is None:
+        return maximum
+
+    try:
+        return max(1, min(maximum, int(value)))
+    except ValueError:
+        sys.stderr.write(f"Ignoring invalid PHOTOSIFTER_PAGE_SIZE value '{value}'.\n")
+        return maximum
+
 
 class GooglePhotosLibrary:
 
-    # This is the maximum size that Google Photos API allows.
-    PAGE_SIZE = 100
+    # This is the maximum size that Google Photos API allows (it can be
+    # lowered through the environment, e.g. for testing).
+    PAGE_SIZE = get_page_size()
 
-    def __init__(self):
+    # Next page is requested in advance once fewer photos than this remain
+    LOW_WATERMARK = 20
+
+    # HTTP statuses of temporary failures worth retrying (rate limits and
+    # server errors)
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, page_cache=False):
+        """Initialize connection to the Google Photos library.
+
+        Args:
+            page_cache: whether to cache listed pages of media items on the disk
+                (these don't contain base URLs, so they cannot be used for
+                downloading).
+        """
 
         def get_photos_service():
             # Request read and write access without the sharing one
@@ -48,34 +129,133 @@ class GooglePhotosLibrary:
                 with open(credentials_file, 'w') as token:
                     token.write(creds.to_json())
 
-            return build('photoslibrary', 'v1', credentials=creds, static_discovery=False)
+            # Photos Library API is not among the static discovery documents
+            # of the client library, so they are cached by us instead.
+            return build_from_document(get_discovery_document(), credentials=creds)
 
         self._previous = None
+        self._page_cache = page_cache
         self._service = get_photos_service()
-        self._results = self._service.mediaItems().list(pageSize=self.PAGE_SIZE).execute()
 
-    def get_next(self):
-        while True:
-            while 'mediaItems' not in self._results or not self._results['mediaItems']:
-                # nextPageToken can be missing but I have so many photos.....
-                self._results = self._service.mediaItems().list(
-                    pageSize=self.PAGE_SIZE,
-                    pageToken=self._results['nextPageToken']).execute()
+        # All requests are executed by this single thread (the service object
+        # is not thread safe), which also downloads the next page in advance.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._next_page_token = None
+        self._next_page = self._executor.submit(self._list_page, None)
 
-            mediaItem = self._results['mediaItems'][0]
-            del self._results['mediaItems'][:1]
+        # Usable photos of the current page
+        self._items = deque()
 
-            # This is an image file
-            if 'photo' in mediaItem['mediaMetadata']:
-                # We cannot process gif files
-                if mediaItem['mimeType'] == 'image/gif':
-                    continue
+    def _prefetch(self):
+        """Start downloading of the next page (if there is one and it is not
+        already being downloaded)."""
+        if self._next_page is not None or self._next_page_token is None:
+            return
 
-                self._previous = mediaItem['id']
-                return mediaItem
+        self._next_page = self._executor.submit(self._list_page, self._next_page_token)
+
+    def _execute_with_backoff(self, request, attempts=6):
+        """Execute given API request, retrying temporary failures with
+        exponential backoff."""
+        for attempt in range(attempts):
+            try:
+                return request.execute()
+            except HttpError as err:
+                if err.resp.status not in self.RETRY_STATUSES or attempt == attempts - 1:
+                    raise
+                time.sleep(min(60, 0.5 * 2 ** attempt) + random.random() * 0.25)
+
+    def _list_page(self, page_token):
+        """Get page of media items with given token (from the cache if enabled)."""
+        # Let the server filter out videos, so that whole pages are usable
+        body = {
+            'pageSize': self.PAGE_SIZE,
+            'filters': {'mediaTypeFilter': {'mediaTypes': ['PHOTO']}},
+        }
+        if page_token is not None:
+            body['pageToken'] = page_token
+        request = self._service.mediaItems().search(body=body)
+        if not self._page_cache:
+            return self._execute_with_backoff(request)
+
+        digest = hashlib.sha1((page_token or "").encode()).hexdigest()
+        cache_file = os.path.join(PAGE_CACHE_DIR, f"{digest}.json")
+        try:
+            if time.time() - os.path.getmtime(cache_file) < PAGE_CACHE_TTL:
+                with open(cache_file, 'r') as infile:
+                    return json.load(infile)
+        except (OSError, ValueError):
+            pass
+
+        results = self._execute_with_backoff(request)
+
+        # Base URLs expire after an hour, so they must not be cached
+        for mediaItem in results.get('mediaItems', []):
+            mediaItem.pop('baseUrl', None)
+
+        try:
+            os.makedirs(PAGE_CACHE_DIR, exist_ok=True)
+            with open(cache_file, 'w') as outfile:
+                json.dump(results, outfile)
+        except OSError:
+            pass
+        return results
+
+    def _accept_page(self, results):
+        """Take usable photos from given page of results."""
+        self._next_page_token = results.get('nextPageToken')
+        self._items = deque(
+            mediaItem
+            for mediaItem in results.get('mediaItems', [])
+            # We cannot process gif files
+            if mediaItem['mimeType'] != 'image/gif'
+        )
+
+    def _fill(self):
+        """Wait until there are some usable photos buffered."""
+        while not self._items:
+            self._prefetch()
+            if self._next_page is None:
+                raise StopIteration("There are no more photos in the library")
+            results = self._next_page.result()
+            self._next_page = None
+            self._accept_page(results)
+
+    def get_next(self):
+        self._fill()
+
+        mediaItem = self._items.popleft()
+        if len(self._items) < self.LOW_WATERMARK:
+            self._prefetch()
+
+        self._previous = mediaItem['id']
+        return mediaItem
 
     def get_multiple(self, amount):
-        return [self.get_next() for _ in range(amount)]
+        """Get list of given amount of photos (shorter one if there are not
+        enough remaining in the library)."""
+
+        # Start downloading the next page right away if the current one
+        # cannot satisfy the whole request.
+        if len(self._items) < amount:
+            self._prefetch()
+
+        # Take as many photos from each page at once as possible
+        mediaItems = []
+        while len(mediaItems) < amount:
+            try:
+                self._fill()
+            except StopIteration:
+                break
+            take = min(amount - len(mediaItems), len(self._items))
+            mediaItems.extend(self._items.popleft() for _ in range(take))
+
+        if len(self._items) < self.LOW_WATERMARK:
+            self._prefetch()
+
+        if mediaItems:
+            self._previous = mediaItems[-1]['id']
+        return mediaItems
 
     def create_album(self, title):
         # This is unused due to the problem in add_to_album
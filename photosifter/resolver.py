@@ -8,7 +8,7 @@ from photosifter.remote import GooglePhotosLibrary
 def resolve(args):
 
     try:
-        library = GooglePhotosLibrary()
+        library = GooglePhotosLibrary(page_cache=args.cache)
     except FileNotFoundError as err:
         sys.stderr.write(f"{err}\n\n"
             "To run in the remote mode, you must have client_secret.json file with\n"
@@ -23,19 +23,24 @@ def resolve(args):
         sys.exit(1)
 
     total = len(files)
+    # Set of (not yet resolved) files for fast lookup
+    remaining = set(files)
 
     resolved = {}
     for _ in range(args.limit):
-        item = library.get_next()
+        try:
+            item = library.get_next()
+        except StopIteration:
+            break
         filename = item['filename']
 
-        if filename in files:
+        if filename in remaining:
             resolved[filename] = item['productUrl']
-            files.remove(filename)
+            remaining.remove(filename)
             if args.verbose:
                 print(f"[{len(resolved)}/{total}] found {filename}")
 
-        if not files:
+        if not remaining:
             break
 
     print("Resolved files:")
@@ -44,6 +49,6 @@ def resolve(args):
     else:
         print(json.dumps(list(resolved.values())))
 
-    if files:
+    if remaining:
         print("Unresolved files:")
-        print(files)
+        print([filename for filename in files if filename in remaining])
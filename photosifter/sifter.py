@@ -1,11 +1,13 @@
 import enum
 import os
+import platform
 import sys
 import cv2
 
 from photosifter.util import verbose
 
-from photosifter.remote import GooglePhotosLibrary
+from photosifter.focus_cache import FocusCache
+
 from photosifter.display import DisplayHandler
 from photosifter.display import MAXIMUM_DISPLAY_SIZE
 from photosifter.display import BORDER
@@ -38,10 +40,49 @@ class KEY(enum.IntEnum):
     Z = 122
 
 
+def read_key():
+    """Block until a key is pressed and return its code.
+
+    This should be the only place calling cv2.waitKey for the user input, so
+    that no key presses are lost.
+    """
+    key = -1
+    while key == -1:
+        key = cv2.waitKey(0)
+    return key
+
+
+def check_opencv_build():
+    """Warn if OpenCV lacks vectorized AVX2 kernels (and print in verbose
+    mode whether it might lack SIMD accelerated JPEG decoder)."""
+
+    info = cv2.getBuildInformation()
+
+    # AVX2 exists only on x86 processors
+    if platform.machine().lower() in ("x86_64", "amd64", "i386", "i686", "x86"):
+        if "AVX2" not in info:
+            sys.stderr.write("Warning: OpenCV was built without AVX2 support, "
+                             "image processing will be slower.\n")
+        # Not all OpenCV versions export the CPU feature constants
+        cpu_avx2 = getattr(cv2, "CPU_AVX2", None)
+        if cpu_avx2 is not None and not cv2.checkHardwareSupport(cpu_avx2):
+            sys.stderr.write("Warning: CPU does not support AVX2 instructions.\n")
+
+    # Builds linked with system libjpeg-turbo report it just as libjpeg,
+    # so this is only a hint
+    if "libjpeg-turbo" not in info:
+        verbose("OpenCV might be built without libjpeg-turbo, "
+                "image decoding would be slower.")
+
+
 def sift(args):
 
+    check_opencv_build()
+
     # Initialize GooglePhotosLibrary object for remote connection
     if args.action == "remote":
+        # Google API client libraries are not needed for the local mode
+        from photosifter.remote import GooglePhotosLibrary
         try:
             library = GooglePhotosLibrary()
         except FileNotFoundError as err:
@@ -51,11 +92,15 @@ def sift(args):
                 "not be required after the authentication is complete.\n")
             sys.exit(11)
 
+    focus_cache = None
     try:
         if args.action == "remote":
-            handler = RemoteImageHandler(args.images, library, args.backup_maxlen)
+            handler = RemoteImageHandler(args.images, library, args.backup_maxlen,
+                                         args.full_size)
         else:
-            handler = ImageHandler(args.images, args.with_threading, args.backup_maxlen)
+            focus_cache = FocusCache(args.images)
+            handler = ImageHandler(args.images, args.with_threading, args.backup_maxlen,
+                                   focus_cache)
     except IOError as err:
         sys.stderr.write(f"Cannot open directory '{args.images}'\n{err}\n")
         sys.exit(1)
@@ -79,110 +124,150 @@ def sift(args):
     swap_first = 0
 
     amount = 2
-    rerender = True
-
-    while True:
-
-        if rerender:
-            image_objects = handler.get_list(amount)
-            display.render(image_objects)
+    running = True
 
-        rerender = False
+    # Each key handler gets the pressed key and returns whether it is
+    # necessary to rerender the current view.
 
-        key = -1
-        while key == -1:
-            key = cv2.waitKey(1000)
+    def roll_right(_):
+        return handler.roll_right()
 
-        if key in [KEY.LEFT, KEY.COMMA]:
-            rerender = handler.roll_right()
+    def roll_left(_):
+        return handler.roll_left()
 
-        elif key in [KEY.RIGHT, KEY.DOT]:
-            rerender = handler.roll_left()
+    def delete_shortcut(key):
+        if amount == 1:
+            if key != KEY.D:
+                return False
+            idx = 0
 
-        elif key in [KEY.A, KEY.D, KEY.S]:
+        elif amount == 2 and len(handler) > 1:
 
-            if amount == 1:
-                if key != KEY.D:
-                    continue
+            if key == KEY.A:
                 idx = 0
+            elif key == KEY.D:
+                idx = 1
 
-            elif amount == 2 and len(handler) > 1:
+            elif key == KEY.S:
+                difference = handler.get_relative(0).focus - handler.get_relative(1).focus
 
-                if key == KEY.A:
-                    idx = 0
-                elif key == KEY.D:
-                    idx = 1
+                if abs(difference) < args.threshold:
+                    return False
 
-                elif key == KEY.S:
-                    difference = handler.get_relative(0).focus - handler.get_relative(1).focus
+                idx = int(difference > 0)
 
-                    if abs(difference) < args.threshold:
-                        continue
-
-                    idx = int(difference > 0)
-
-            else:
-                # These convenient key bindings do nothing for more concatenated photos
-                continue
+        else:
+            # These convenient key bindings do nothing for more concatenated photos
+            return False
 
-            handler.delete_image(idx, amount)
-            rerender = True
+        handler.delete_image(idx, amount)
+        return True
 
-        elif key in [KEY.Y, KEY.Z]:
-            handler.restore_last()
-            rerender = True
+    def restore_last(_):
+        handler.restore_last()
+        return True
 
-        elif key == KEY.F:
-            display.toggle_fullscreen()
+    def toggle_fullscreen(_):
+        display.toggle_fullscreen()
+        return False
 
-        elif key == KEY.P:
-            display.toggle_text_embeding()
-            rerender = True
+    def toggle_text_embeding(_):
+        display.toggle_text_embeding()
+        return True
 
-        elif key == KEY.L:
-            if swap_mode:
-                display.render_border()
+    def toggle_swap_mode(_):
+        nonlocal swap_mode, swap_first
+        if swap_mode:
+            display.render_border()
+        else:
+            display.render_border(BORDER.GREEN)
+        swap_first = 0
+        swap_mode = not swap_mode
+        return False
+
+    def toggle_resize_mode(_):
+        nonlocal resize_mode
+        if resize_mode:
+            display.render_border()
+        else:
+            display.render_border(BORDER.BLUE)
+        resize_mode = not resize_mode
+        return False
+
+    def close(_):
+        nonlocal running
+        running = False
+        return False
+
+    def number_pressed(value):
+        nonlocal resize_mode, swap_mode, swap_first, amount
+        if resize_mode:
+            resize_mode = False
+            amount = value
+        elif swap_mode:
+            if value > amount:
+                return False
+            if swap_first:
+                swap_mode = False
+                handler.swap_images(swap_first - 1, value - 1)
             else:
-                display.render_border(BORDER.GREEN)
-            swap_first = 0
-            swap_mode = not swap_mode
+                swap_first = value
+                return False
+        else:
+            if value > amount:
+                return False
+            handler.delete_image(value - 1, amount)
+        return True
+
+    key_handlers = {
+        KEY.LEFT: roll_right,
+        KEY.COMMA: roll_right,
+        KEY.RIGHT: roll_left,
+        KEY.DOT: roll_left,
+        KEY.A: delete_shortcut,
+        KEY.D: delete_shortcut,
+        KEY.S: delete_shortcut,
+        KEY.Y: restore_last,
+        KEY.Z: restore_last,
+        KEY.F: toggle_fullscreen,
+        KEY.P: toggle_text_embeding,
+        KEY.L: toggle_swap_mode,
+        KEY.R: toggle_resize_mode,
+        KEY.ESC: close,
+        KEY.X: close,
+    }
 
-        elif key == KEY.R:
-            if resize_mode:
-                display.render_border()
-            else:
-                display.render_border(BORDER.BLUE)
-            resize_mode = not resize_mode
+    rerender = True
+    while running:
 
-        elif key in [KEY.ESC, KEY.X]:
-            break
+        if rerender:
+            image_objects = handler.get_list(amount)
+            # All remaining images failed to download
+            if not image_objects:
+                break
+            display.render(image_objects)
+            handler.preload_neighbours(amount)
 
-        elif KEY.ONE <= key < KEY.ONE + MAXIMUM_DISPLAY_SIZE:
-
-            value = key - ord('0')
-            if resize_mode:
-                resize_mode = False
-                amount = value
-            elif swap_mode:
-                if value > amount:
-                    continue
-                if swap_first:
-                    swap_mode = False
-                    handler.swap_images(swap_first - 1, value - 1)
-                else:
-                    swap_first = value
-                    continue
-            else:
-                if value > amount:
-                    continue
-                handler.delete_image(value - 1, amount)
-            rerender = True
+        # Block until a key is pressed, there is nothing to do meanwhile
+        # (preloading is done by the background worker).
+        key = read_key()
 
+        offset = key - KEY.ONE
+        if 0 <= offset < MAXIMUM_DISPLAY_SIZE:
+            rerender = number_pressed(offset + 1)
         else:
-            verbose(f"Key {key} pressed.")
+            key_handler = key_handlers.get(key)
+            if key_handler is None:
+                verbose(f"Key {key} pressed.")
+                rerender = False
+            else:
+                rerender = key_handler(key)
 
         if len(handler) < 2:
             break
 
     del display
     del handler
+
+    if focus_cache is not None:
+        focus_cache.save()
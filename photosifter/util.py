@@ -3,6 +3,7 @@ import os
 # Get absolute path to credentials folder
 current = os.path.dirname(os.path.realpath(__file__))
 AUTH_BASE = os.path.normpath(os.path.join(current, "auth"))
+CACHE_BASE = os.path.normpath(os.path.join(current, "cache"))
 
 # global funcion for non verbose printing
 enable_verbose = False